@@ -2,15 +2,27 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import akshare as ak
-import yfinance as yf
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import io
+import math
+import re
 import time
 import random
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tools.cache import FileCache, HIST_TTL
 
 st.set_page_config(page_title="厉害了，股神", page_icon="📈", layout="centered")
 
+# Copy-on-Write让tail/切片默认懒拷贝，只读路径不再实际分配
+# pandas 3.0起默认开启且选项废弃，只在旧版本上显式打开
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
 # ---------------------
 # 市场识别函数
 # ---------------------
@@ -19,196 +31,471 @@ def identify_market(stock_code):
     自动识别股票代码所属的市场
     返回: market_type, normalized_code
     """
-    code = str(stock_code).strip().upper()
-    
-    # 美股识别（字母代码）[5](@ref)
-    if code.isalpha():
-        return 'US', code
-    
-    # 纯数字代码识别
-    if code.isdigit():
-        # A股: 6位数字
+    # 先归一化再进缓存，让 'aapl ' 和 'AAPL' 命中同一条目
+    return _classify_code(str(stock_code).strip().upper())
+
+# 1-6位纯数字一次fullmatch判定，代替逐分支isdigit重扫
+_DIGIT_CODE_RE = re.compile(r"\d{1,6}")
+# 交易所首位数字集合：单字符in frozenset比startswith元组逐个比对更快
+_SH_PREFIXES = frozenset("659")
+_SZ_PREFIXES = frozenset("023")
+
+@lru_cache(maxsize=256)
+def _classify_code(code):
+    """纯字符串分类，入参已strip/upper，结果可安全记忆化"""
+    if _DIGIT_CODE_RE.fullmatch(code):
         if len(code) == 6:
-            if code.startswith(('6', '5', '9')):  # 上交所
+            if code[0] in _SH_PREFIXES:  # 上交所
                 return 'A', code + '.SS'
-            elif code.startswith(('0', '2', '3')):  # 深交所
+            if code[0] in _SZ_PREFIXES:  # 深交所
                 return 'A', code + '.SZ'
+            return 'A', code
         # 港股: 1-5位数字，补足到5位
-        elif 1 <= len(code) <= 5:
-            return 'H', code.zfill(5) + '.HK'
-    
+        return 'H', code.zfill(5) + '.HK'
+
+    # 美股识别（字母代码）[5](@ref)
+    if code.isalpha():
+        return 'US', code
+
     # 默认按A股处理
     return 'A', code
 
 # ---------------------
 # 增强的数据获取函数
 # ---------------------
+HIST_CACHE_TTL = 3600  # 行情缓存1小时，避免每次rerun都重新请求
+
+class DataFetchError(Exception):
+    """行情数据获取失败（重试耗尽或上游接口异常）"""
+
+def _iso_date(yyyymmdd):
+    """YYYYMMDD -> YYYY-MM-DD，yfinance只认ISO格式"""
+    return f"{yyyymmdd[:4]}-{yyyymmdd[4:6]}-{yyyymmdd[6:]}"
+
+@st.cache_resource
+def get_disk_cache():
+    """跨rerun共享的磁盘缓存实例，重启后数据仍在"""
+    return FileCache()
+
+@st.cache_resource
+def get_http_session():
+    """连接池复用的requests会话，避免每次请求重新做TCP+TLS握手"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                          max_retries=Retry(total=3, backoff_factor=0.5,
+                                            status_forcelist=(429, 500, 502, 503, 504)))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Yahoo对无UA请求限流更狠，带上浏览器UA
+    session.headers["User-Agent"] = "Mozilla/5.0"
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_ticker(symbol):
+    """按代码复用yf.Ticker：实例内部缓存的元数据跨rerun保留"""
+    import yfinance as yf
+    return yf.Ticker(symbol, session=get_http_session())
+
+@st.cache_data(ttl=HIST_CACHE_TTL, max_entries=256, show_spinner=False)
+def _fetch_hist(market_type, normalized_code, start_date, end_date):
+    """
+    按市场类型拉取日线行情，结果按 (市场, 代码, 日期区间) 缓存
+    日期参数按天对齐，保证同一天内缓存键稳定
+    """
+    # akshare连带lxml/bs4等一大串依赖，推迟到真正发请求时才加载
+    import akshare as ak
+
+    df = None
+    max_retries = 3
+
+    for attempt in range(max_retries):
+        try:
+            if market_type == 'A':
+                # A股使用akshare
+                df = ak.stock_zh_a_hist(symbol=normalized_code.replace('.SS', '').replace('.SZ', ''),
+                                      period="daily", start_date=start_date, end_date=end_date,
+                                      adjust="qfq")
+            elif market_type == 'H':
+                # 港股使用akshare
+                df = ak.stock_hk_hist(symbol=normalized_code.replace('.HK', ''), period="daily",
+                                    start_date=start_date, end_date=end_date)
+            elif market_type == 'US':
+                # 美股使用yfinance（更稳定）[5](@ref)，Ticker实例与连接池会话都跨rerun复用
+                # 与A/H股共用同一日期窗口，不再硬编码period="6mo"
+                ticker = get_ticker(normalized_code)
+                # yfinance的end是开区间，+1天才包含end_date当天
+                end_excl = (datetime.strptime(end_date, "%Y%m%d")
+                            + timedelta(days=1)).strftime("%Y-%m-%d")
+                # actions=False让Yahoo直接不返回Dividends/Splits列，省下下游丢弃
+                df = ticker.history(start=_iso_date(start_date), end=end_excl,
+                                    interval="1d", actions=False)
+                if df is not None and not df.empty:
+                    # 标准化列名
+                    df = df.rename(columns={
+                        'Open': 'open', 'High': 'high', 'Low': 'low',
+                        'Close': 'close', 'Volume': 'volume'
+                    })
+
+            if df is not None and not df.empty:
+                break
+
+        except (requests.RequestException, ValueError, KeyError) as e:
+            if attempt == max_retries - 1:
+                raise DataFetchError(f"获取 {normalized_code} 行情失败: {e}") from e
+            # 指数退避重试
+            time.sleep(random.uniform(1, 3))
+
+    # 空结果以异常冒出而不是返回：st.cache_data不缓存异常，
+    # 避免一次瞬时空响应在整个TTL内钉死"未获取到数据"
+    if df is None or df.empty:
+        raise DataFetchError(f"未获取到 {normalized_code} 在 {start_date}-{end_date} 的行情数据")
+    return df
+
+def _last_cached_day(base_df):
+    """从缓存的原始行情取最后交易日，返回 (日期列名, 最后交易日Timestamp)"""
+    col_map = _normalize_columns(base_df.columns)
+    date_col = next((c for c, t in col_map.items() if t == "date"), None)
+    if date_col is None:
+        return None, None
+    last = pd.to_datetime(base_df[date_col], errors="coerce").max()
+    if pd.isna(last):
+        return date_col, None
+    return date_col, last
+
+def _seam_matches(base, delta, date_col, last_ts, rel_tol=1e-3):
+    """
+    比对底仓与增量在重叠交易日的收盘价
+    qfq复权价在每次除权除息后整体重锚，收盘对不上说明底仓已过期，不能拼接
+    无法比对（缺列/缺重叠行）时放行，维持原有拼接行为
+    """
+    col_map = _normalize_columns(base.columns)
+    close_col = next((c for c, t in col_map.items() if t == "close"), None)
+    if close_col is None or close_col not in delta.columns or date_col not in delta.columns:
+        return True
+    old = base.loc[pd.to_datetime(base[date_col], errors="coerce") == last_ts, close_col]
+    new = delta.loc[pd.to_datetime(delta[date_col], errors="coerce") == last_ts, close_col]
+    if old.empty or new.empty:
+        return True
+    try:
+        return math.isclose(float(old.iloc[-1]), float(new.iloc[0]),
+                            rel_tol=rel_tol, abs_tol=1e-6)
+    except (TypeError, ValueError):
+        return True
+
+def _fetch_with_topup(market_type, normalized_code, start_date, end_date):
+    """
+    磁盘缓存优先的行情获取
+    缓存过期但仍有旧数据时，A/H股只抓最后缓存日之后的增量再拼接，
+    避免每天重新下载整段历史
+    """
+    cache = get_disk_cache()
+    df = cache.get(market_type, normalized_code, start_date, end_date)
+    if df is not None:
+        return df
+
+    base = cache.get_latest(market_type, normalized_code) if market_type in ('A', 'H') else None
+    fetch_start, date_col, last_ts = start_date, None, None
+    if base is not None and not base.empty:
+        date_col, last_ts = _last_cached_day(base)
+        if last_ts is not None:
+            last_day = last_ts.strftime("%Y%m%d")
+            if last_day >= end_date:
+                # 底仓已覆盖到今天，直接续期复用，零网络请求
+                cache.set(market_type, normalized_code, start_date, end_date, base, ttl=HIST_TTL)
+                return base
+            if last_day > start_date:
+                # 从最后缓存日（含）重抓：重叠的那根K线用来校验复权基准没变
+                fetch_start = last_day
+
+    try:
+        delta = _fetch_hist(market_type, normalized_code, fetch_start, end_date)
+    except DataFetchError:
+        # 增量窗口可能恰好没有新交易日（周末/假期），有底仓就直接复用
+        if fetch_start == start_date:
+            raise
+        delta = None
+    if fetch_start != start_date:
+        if delta is not None and not delta.empty:
+            if not _seam_matches(base, delta, date_col, last_ts):
+                # 除权除息后qfq整段重锚，底仓与增量不在同一复权基准上，推倒全量重抓
+                cache.invalidate(normalized_code)
+                df = _fetch_hist(market_type, normalized_code, start_date, end_date)
+            else:
+                df = pd.concat([base, delta], ignore_index=True)
+                df = df.drop_duplicates(subset=date_col, keep="last")
+        else:
+            df = base
+    else:
+        df = delta
+
+    if df is not None and not df.empty:
+        cache.set(market_type, normalized_code, start_date, end_date, df, ttl=HIST_TTL)
+    return df
+
+NAME_CACHE_TTL = 86400  # 名称表一天拉一次
+
+@st.cache_data(ttl=NAME_CACHE_TTL, persist="disk", show_spinner=False)
+def _load_name_table(market_type):
+    """
+    整张代码-名称表一次性下载并转成 {代码: 名称} 字典
+    之后查名称是O(1)字典读取，而不是每次rerun扫描几千行的表
+    """
+    import akshare as ak
+
+    if market_type == 'A':
+        table = ak.stock_info_a_code_name()
+        return dict(zip(table["code"].astype(str), table["name"]))
+    if market_type == 'H':
+        spot = ak.stock_hk_spot()
+        return dict(zip(spot["symbol"].astype(str), spot["name"]))
+    if market_type == 'US':
+        spot = ak.stock_us_spot()
+        return dict(zip(spot["symbol"].astype(str), spot["cname"]))
+    return {}
+
+def get_stock_name(market_type, stock_code):
+    """查询股票名称，查不到或网络异常时返回空串，不影响主流程"""
+    code = str(stock_code).split('.')[0]
+    try:
+        return _load_name_table(market_type).get(code, "")
+    except Exception:
+        # 名称只是装饰性文案，akshare上游改版抛什么异常都不值得中断分析
+        return ""
+
 def get_stock_data(stock_code):
     """
     增强版股票数据获取，支持A股、港股、美股
     """
+    # 识别市场类型
+    market_type, normalized_code = identify_market(stock_code)
+
+    # date.today()天然按天取整，缓存键在同一交易日内稳定
+    today = date.today()
+    end_date = today.strftime("%Y%m%d")
+    start_date = (today - timedelta(days=180)).strftime("%Y%m%d")
+
+    # 磁盘缓存/增量拼接都在_fetch_with_topup里处理
+    # try只包住网络抓取：取数之后的热路径让真正的bug直接冒出来
     try:
-        # 识别市场类型
-        market_type, normalized_code = identify_market(stock_code)
-        
-        df = None
-        max_retries = 3
-        
-        for attempt in range(max_retries):
-            try:
-                if market_type == 'A':
-                    # A股使用akshare
-                    df = ak.stock_zh_a_hist(symbol=normalized_code.replace('.SS', '').replace('.SZ', ''), 
-                                          period="daily", adjust="qfq")
-                elif market_type == 'H':
-                    # 港股使用akshare
-                    df = ak.stock_hk_hist(symbol=normalized_code.replace('.HK', ''), period="daily")
-                elif market_type == 'US':
-                    # 美股使用yfinance（更稳定）[5](@ref)
-                    ticker = yf.Ticker(normalized_code)
-                    df = ticker.history(period="6mo", interval="1d")
-                    if df is not None and not df.empty:
-                        # 标准化列名
-                        df = df.rename(columns={
-                            'Open': 'open', 'High': 'high', 'Low': 'low', 
-                            'Close': 'close', 'Volume': 'volume'
-                        })
-                
-                if df is not None and not df.empty:
-                    break
-                    
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    raise e
-                # 指数退避重试
-                time.sleep(random.uniform(1, 3))
-        
-        if df is None or df.empty:
-            st.warning(f"未获取到 {normalized_code} 的历史行情数据")
-            return None, normalized_code
-
-        # 数据预处理
-        df = preprocess_dataframe(df, market_type)
-        if df is None:
-            return None, normalized_code
-            
-        # 计算技术指标
-        df = calculate_technical_indicators(df)
-        
-        return df, normalized_code
-        
-    except Exception as e:
+        # 行情与名称两路独立请求并发执行，握手和RTT相互重叠
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            hist_future = pool.submit(_fetch_with_topup, market_type, normalized_code,
+                                      start_date, end_date)
+            name_future = pool.submit(get_stock_name, market_type, normalized_code)
+            df = hist_future.result()
+            stock_name = name_future.result()
+    except (DataFetchError, requests.RequestException) as e:
         st.error(f"获取数据时出错: {str(e)}")
-        return None, stock_code
+        return None, normalized_code
+
+    display_name = f"{normalized_code} {stock_name}".strip()
+
+    if df is None or df.empty:
+        st.warning(f"未获取到 {normalized_code} 的历史行情数据")
+        return None, display_name
+
+    # 数据预处理
+    df = preprocess_dataframe(df, market_type)
+    if df is None:
+        return None, display_name
+
+    # 计算技术指标（按代码+最新交易日记忆化）
+    last_date = str(df["date"].iloc[-1]) if "date" in df.columns else str(len(df))
+    df = _indicators_cached(normalized_code, last_date, df)
+
+    return df, display_name
+
+# 已知列名到标准名的常量映射，覆盖akshare/yfinance的常见返回
+_COLUMN_ALIASES = {
+    "日期": "date", "date": "date", "datetime": "date",
+    "开盘": "open", "open": "open",
+    "收盘": "close", "close": "close",
+    "最高": "high", "high": "high",
+    "最低": "low", "low": "low",
+    "成交量": "volume", "volume": "volume", "交易量": "volume",
+}
+
+# 兜底匹配：预编译正则一次C级扫描，首个命中的关键词决定标准名
+_COL_RE = re.compile(r"(日期|date|开盘|open|收盘|close|最高|high|最低|low|成交量|交易量|volume)")
+_COL_GROUP_TO_NAME = {
+    "日期": "date", "date": "date",
+    "开盘": "open", "open": "open",
+    "收盘": "close", "close": "close",
+    "最高": "high", "high": "high",
+    "最低": "low", "low": "low",
+    "成交量": "volume", "交易量": "volume", "volume": "volume",
+}
+
+def _normalize_columns(columns):
+    """列名标准化：先查常量映射表，查不到再用预编译正则兜底"""
+    col_map = {}
+    for col in columns:
+        col_str = str(col).strip().lower()
+        target = _COLUMN_ALIASES.get(col_str)
+        if target is None:
+            m = _COL_RE.search(col_str)
+            if m:
+                target = _COL_GROUP_TO_NAME[m.group(1)]
+        if target is not None:
+            col_map[col] = target
+    return col_map
+
+HISTORY_WINDOW = 120  # 分析/展示用的最近交易日数
 
 def preprocess_dataframe(df, market_type):
     """统一处理不同市场返回的数据框"""
-    df = df.copy()
-    
-    # 统一列名映射
-    col_map = {}
-    for col in df.columns:
-        col_str = str(col).lower()
-        if any(x in col_str for x in ['日期', 'date']):
-            col_map[col] = "date"
-        elif any(x in col_str for x in ['开盘', 'open']):
-            col_map[col] = "open"
-        elif any(x in col_str for x in ['收盘', 'close']):
-            col_map[col] = "close"
-        elif any(x in col_str for x in ['最高', 'high']):
-            col_map[col] = "high"
-        elif any(x in col_str for x in ['最低', 'low']):
-            col_map[col] = "low"
-        elif any(x in col_str for x in ['成交量', 'volume', '交易量']):
-            col_map[col] = "volume"
-    
+    # 多级列头（如yf.download单票返回）压平；nlevels是O(1)属性读
+    if df.columns.nlevels > 1:
+        df.columns = df.columns.droplevel(-1)
+
+    # 统一列名映射（rename返回浅拷贝，省掉入口处的整表深拷贝）
+    col_map = _normalize_columns(df.columns)
     if col_map:
-        df.rename(columns=col_map, inplace=True)
+        df = df.rename(columns=col_map)
     
     # 处理日期列
     if "date" in df.columns:
         try:
-            df["date"] = pd.to_datetime(df["date"])
-        except:
-            pass
+            # akshare固定返回YYYY-MM-DD，显式format跳过pandas逐值推断
+            df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d", cache=True)
+        except (ValueError, TypeError):
+            # 非字符串或其他格式（如date对象）走通用解析
+            df["date"] = pd.to_datetime(df["date"], errors="coerce")
     elif isinstance(df.index, pd.DatetimeIndex):
-        df = df.reset_index().rename(columns={"index": "date"})
+        # yfinance的索引本来就是DatetimeIndex（名为"Date"），统一命名后抬成列，无需重新解析
+        df.index.name = "date"
+        df = df.reset_index()
     
     # 确保有close列
     if "close" not in df.columns:
         st.error(f"数据中缺少close列，可用列: {list(df.columns)}")
         return None
+
+    # 只留下游用到的列，甩掉Dividends/涨跌幅/换手率等附带列，缩小缓存与后续各遍的足迹
+    df = df[[c for c in ("date", "open", "high", "low", "close", "volume") if c in df.columns]]
     
-    # 按日期排序并取最近120天
+    # 按日期排序并取最近120天；数据源基本都是升序返回，先O(n)探测避免白排一遍
     if "date" in df.columns:
-        df = df.sort_values("date").tail(120).reset_index(drop=True)
+        if not df["date"].is_monotonic_increasing:
+            df = df.sort_values("date", kind="stable", ignore_index=True)
+        df = df.iloc[-HISTORY_WINDOW:].reset_index(drop=True)
     else:
-        df = df.tail(120).copy()
-    
-    # 数值列转换
-    numeric_cols = ["close", "open", "high", "low", "volume"]
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
-    
+        df = df.tail(HISTORY_WINDOW).reset_index(drop=True)
+
+    # 数值列在截取后一次性转换，只处理实际存在的列
+    present = [c for c in ("close", "open", "high", "low", "volume") if c in df.columns]
+    df[present] = df[present].apply(pd.to_numeric, errors="coerce")
+
+    # 价格6位有效数字足够，float32把工作集字节减半；成交量尽量整型
+    price_cols = [c for c in ("open", "high", "low", "close") if c in df.columns]
+    df[price_cols] = df[price_cols].astype(np.float32)
+    if "volume" in df.columns:
+        df["volume"] = pd.to_numeric(df["volume"], downcast="unsigned")
+
     return df
 
+def _rolling_means(close, windows=(5, 20, 50)):
+    """
+    一次累计和推出全部均线，整体O(n)
+    语义等价 rolling(window=w, min_periods=1).mean()：窗口内只对非NaN取均值
+    """
+    valid = ~np.isnan(close)
+    csum = np.concatenate(([0.0], np.cumsum(np.where(valid, close, 0.0))))
+    ccnt = np.concatenate(([0], np.cumsum(valid)))
+    idx = np.arange(close.size)
+    out = {}
+    for w in windows:
+        lo = np.maximum(idx - w + 1, 0)
+        total = csum[idx + 1] - csum[lo]
+        count = ccnt[idx + 1] - ccnt[lo]
+        out[w] = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+    return out
+
+def _macd_kernel(close, a12=2 / 13, a26=2 / 27, a9=2 / 10):
+    """
+    单遍递推算出DIF/DEA/MACD，等价三次ewm(span=..., adjust=False)
+    NaN按跳过处理（收盘价经预处理后不含内部NaN，差异可忽略）
+    """
+    n = close.size
+    dif = np.empty(n)
+    dea = np.empty(n)
+    e12 = e26 = d = np.nan
+    for i in range(n):
+        x = close[i]
+        if not np.isnan(x):
+            e12 = x if np.isnan(e12) else a12 * x + (1 - a12) * e12
+            e26 = x if np.isnan(e26) else a26 * x + (1 - a26) * e26
+        dif[i] = e12 - e26
+        if not np.isnan(dif[i]):
+            d = dif[i] if np.isnan(d) else a9 * dif[i] + (1 - a9) * d
+        dea[i] = d
+    return dif, dea, 2 * (dif - dea)
+
 def calculate_technical_indicators(df):
     """计算技术指标"""
-    # 移动平均线
-    df["MA5"] = df["close"].rolling(window=5, min_periods=1).mean()
-    df["MA20"] = df["close"].rolling(window=20, min_periods=1).mean()
-    df["MA50"] = df["close"].rolling(window=50, min_periods=1).mean()
-    
-    # MACD
-    ema12 = df["close"].ewm(span=12, adjust=False).mean()
-    ema26 = df["close"].ewm(span=26, adjust=False).mean()
-    df["DIF"] = ema12 - ema26
-    df["DEA"] = df["DIF"].ewm(span=9, adjust=False).mean()
-    df["MACD"] = 2 * (df["DIF"] - df["DEA"])
-    
-    return df
+    # 全部指标先在numpy数组上算好，最后一次assign写回
+    # 避免六次逐列插入导致的BlockManager反复拷贝
+    close = df["close"].to_numpy(dtype=np.float64)
+    mas = _rolling_means(close)
+    dif, dea, macd = _macd_kernel(close)
+    return df.assign(MA5=mas[5], MA20=mas[20], MA50=mas[50],
+                     DIF=dif, DEA=dea, MACD=macd)
+
+@st.cache_data(ttl=HIST_CACHE_TTL, max_entries=256, show_spinner=False)
+def _indicators_cached(code, last_date, _df):
+    """
+    指标流水线按 (代码, 最新交易日) 记忆化
+    _df带下划线前缀不参与哈希，同一交易日内rerun直接取缓存
+    TTL与行情缓存对齐，键退化时也不会永久供给旧结果
+    """
+    return calculate_technical_indicators(_df)
 
 # ---------------------
 # 分析逻辑
 # ---------------------
+# 均线排列符号 -> (情绪文案, 买入区间下/上沿系数, 趋势文案)；其余排列走震荡默认值
+_REGIME_TABLE = {
+    (1, 1): ("🚀 牛气冲天！主力资金强势介入，短期倾向上涨。", 0.95, 1.05, "短期看涨概率约65%"),
+    (-1, -1): ("💸 空头占优，行情承压，建议谨慎观望。", 0.85, 0.95, "短期看跌概率约60%"),
+}
+_REGIME_DEFAULT = ("🎢 震荡整理，短线方向不明，适合高抛低吸。", 0.9, 1.1, "横盘概率约50%")
+
+@lru_cache(maxsize=512)
+def _regime_verdict(ma5, ma20, ma50, current_price):
+    """三种情形判断（入参已确认非NaN，NaN != NaN会让缓存永不命中）"""
+    # 两段均线关系压成符号对，查表代替分支链
+    key = ((ma5 > ma20) - (ma5 < ma20), (ma20 > ma50) - (ma20 < ma50))
+    mood, lo, hi, future_trend = _REGIME_TABLE.get(key, _REGIME_DEFAULT)
+    price_range = "%.2f - %.2f" % (current_price * lo, current_price * hi)
+    return mood, price_range, future_trend
+
 def analyze_stock(df):
     try:
         if df is None or df.empty:
             return "暂无数据", "暂无买入区间", "无法判断趋势"
 
-        latest = df.iloc[-1]
-        ma5 = latest.get("MA5", np.nan)
-        ma20 = latest.get("MA20", np.nan)
-        ma50 = latest.get("MA50", np.nan)
-        current_price = latest.get("close", np.nan)
+        # 一次块读取四列的末行，跳过iloc[-1]构造整行Series和逐列取值
+        cols = [c for c in ("MA5", "MA20", "MA50", "close") if c in df.columns]
+        tail = dict(zip(cols, df[cols].to_numpy(dtype=np.float64)[-1]))
+        ma5 = tail.get("MA5", np.nan)
+        ma20 = tail.get("MA20", np.nan)
+        ma50 = tail.get("MA50", np.nan)
+        current_price = tail.get("close", np.nan)
 
-        if pd.isna(ma5) or pd.isna(ma20) or pd.isna(ma50):
+        # 标量NaN判断用math.isnan，省掉pd.isna的dtype分发
+        if math.isnan(ma5) or math.isnan(ma20) or math.isnan(ma50):
             available = []
-            if not pd.isna(ma5): available.append("MA5")
-            if not pd.isna(ma20): available.append("MA20")
-            if not pd.isna(ma50): available.append("MA50")
+            if not math.isnan(ma5): available.append("MA5")
+            if not math.isnan(ma20): available.append("MA20")
+            if not math.isnan(ma50): available.append("MA50")
             if available:
                 mood = f"🤔 仅检测到指标：{', '.join(available)}，分析结果谨慎参考。"
             else:
                 mood = "📊 指标数据不足，无法给出完整分析。"
             return mood, "暂无买入区间", "无法预测"
 
-        # 三种情形判断
-        if ma5 > ma20 and ma20 > ma50:
-            mood = "🚀 牛气冲天！主力资金强势介入，短期倾向上涨。"
-            price_range = f"{current_price * 0.95:.2f} - {current_price * 1.05:.2f}"
-            future_trend = "短期看涨概率约65%"
-        elif ma5 < ma20 and ma20 < ma50:
-            mood = "💸 空头占优，行情承压，建议谨慎观望。"
-            price_range = f"{current_price * 0.85:.2f} - {current_price * 0.95:.2f}"
-            future_trend = "短期看跌概率约60%"
-        else:
-            mood = "🎢 震荡整理，短线方向不明，适合高抛低吸。"
-            price_range = f"{current_price * 0.9:.2f} - {current_price * 1.1:.2f}"
-            future_trend = "横盘概率约50%"
-
-        return mood, price_range, future_trend
+        # 判断与文案按四个标量指纹记忆化，重复rerun零计算
+        return _regime_verdict(float(ma5), float(ma20), float(ma50), float(current_price))
 
     except Exception as e:
         st.error(f"分析出错: {repr(e)}")
@@ -217,104 +504,168 @@ def analyze_stock(df):
 # ---------------------
 # 绘图函数
 # ---------------------
-def plot_stock_charts(df, display_name):
-    st.subheader(f"📊 {display_name} - 技术分析")
-    
-    if "date" in df.columns:
-        x = df["date"]
-    else:
-        x = df.index
+# PNG体积不小，条目上限收紧些；TTL与行情缓存对齐
+@st.cache_data(ttl=HIST_CACHE_TTL, max_entries=64, show_spinner=False)
+def _render_chart_png(code, last_date, _df):
+    """
+    价格/均线 + MACD两栏图渲染成PNG字节串
+    按 (代码, 最新交易日) 缓存，数据不变时rerun不再重建Figure
+    """
+    # matplotlib只在真正需要画图（缓存未命中）时加载；服务端渲染固定走无头Agg后端
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    df = _df
+    x = df["date"].to_numpy() if "date" in df.columns else df.index.to_numpy()
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 7), sharex=True,
+                                   gridspec_kw={"height_ratios": [3, 1]})
 
     # 价格与均线
-    fig, ax1 = plt.subplots(figsize=(10, 5))
     ax1.plot(x, df["close"], label="收盘价", color="black", linewidth=1)
-    if "MA5" in df.columns: 
+    if "MA5" in df.columns:
         ax1.plot(x, df["MA5"], label="MA5", color="orange", linewidth=0.8)
-    if "MA20" in df.columns: 
+    if "MA20" in df.columns:
         ax1.plot(x, df["MA20"], label="MA20", color="blue", linewidth=0.8)
-    if "MA50" in df.columns: 
+    if "MA50" in df.columns:
         ax1.plot(x, df["MA50"], label="MA50", color="purple", linewidth=0.8)
     ax1.set_ylabel("价格")
     ax1.legend(loc="upper left")
     ax1.grid(True, alpha=0.3)
-    
+
+    # MACD柱：按正负布尔掩码分两次bar，不构造逐元素颜色数组
+    if "MACD" in df.columns:
+        macd = df["MACD"].to_numpy()
+        pos = macd >= 0
+        ax2.bar(x[pos], macd[pos], color="red", alpha=0.6)
+        ax2.bar(x[~pos], macd[~pos], color="green", alpha=0.6)
+        if "DIF" in df.columns:
+            ax2.plot(x, df["DIF"], label="DIF", color="orange", linewidth=0.8)
+        if "DEA" in df.columns:
+            ax2.plot(x, df["DEA"], label="DEA", color="blue", linewidth=0.8)
+        ax2.set_ylabel("MACD")
+        ax2.legend(loc="upper left")
+        ax2.grid(True, alpha=0.3)
+
     plt.xticks(rotation=45)
-    st.pyplot(fig)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=100, bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+def plot_stock_charts(df, display_name):
+    st.subheader(f"📊 {display_name} - 技术分析")
+    last_date = str(df["date"].iloc[-1]) if "date" in df.columns else str(len(df))
+    st.image(_render_chart_png(display_name, last_date, df))
 
 # ---------------------
 # 主程序
 # ---------------------
-def main():
-    st.title("📈 厉害了，股神")
-    st.markdown("""
+@st.fragment
+def render_analysis(code):
+    """分析区独立fragment：内部rerun只重绘本区域，不重跑整个脚本"""
+    with st.spinner("正在获取数据并分析..."):
+        df, display_code = get_stock_data(code)
+
+        if df is not None and not df.empty:
+            # 分析结果
+            mood, price_range, future_trend = analyze_stock(df)
+
+            # 三列显示分析结果
+            col1, col2, col3 = st.columns(3)
+
+            with col1:
+                st.markdown(f"​**当前行情情绪**​")
+                st.info(mood)
+
+            with col2:
+                st.markdown(f"​**建议买入区间**​")
+                st.success(price_range)
+
+            with col3:
+                st.markdown(f"​**未来趋势预测**​")
+                st.warning(future_trend)
+
+            st.divider()
+
+            # 图表显示
+            plot_stock_charts(df, display_code)
+
+            # 最近数据表
+            st.subheader("📋 最近交易数据")
+            display_cols = ["date", "close", "MA5", "MA20", "MA50", "volume"]
+            available_cols = [col for col in display_cols if col in df.columns]
+
+            if available_cols:
+                recent_data = df.tail(10)[available_cols]
+                # 浮点列一次性按块round，不逐列循环
+                # 展示前先回到float64：float32表示不了两位小数，round后会带精度尾巴
+                float_cols = recent_data.select_dtypes("floating").columns
+                recent_data[float_cols] = recent_data[float_cols].astype(np.float64).round(2)
+                st.dataframe(recent_data, use_container_width=True)
+
+            # 显示最新价格
+            latest_price = df.iloc[-1]["close"]
+            st.metric("最新收盘价", f"{latest_price:.2f}",
+                     delta=f"{(latest_price - df.iloc[-2]['close']):.2f}" if len(df) > 1 else None)
+
+        else:
+            st.error("❌ 未能获取股票数据，请检查：")
+            st.error("1. 股票代码是否正确（A股: 600519, 港股: 00700, 美股: AAPL）")
+            st.error("2. 网络连接是否正常")
+            st.error("3. 该股票是否在交易时间")
+
+# 首屏文案里示例过的热门代码，启动时后台预热
+PREFETCH_TICKERS = ("AAPL", "TSLA", "600519", "00700")
+
+@st.cache_resource
+def _warm_popular_tickers():
+    """
+    后台线程预热热门代码的行情缓存，cache_resource保证每进程只跑一次
+    失败静默忽略——预热纯属锦上添花，不该打扰首屏
+    """
+    pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+    today = date.today()
+    end_date = today.strftime("%Y%m%d")
+    start_date = (today - timedelta(days=180)).strftime("%Y%m%d")
+    for ticker in PREFETCH_TICKERS:
+        market_type, normalized_code = identify_market(ticker)
+        pool.submit(_fetch_with_topup, market_type, normalized_code, start_date, end_date)
+    pool.shutdown(wait=False)
+    return True
+
+# 静态首屏文案：常量在import时构建一次，rerun只做发送
+_INTRO_MD = """
     支持A股、港股、美股分析
-    - ​**A股**: 6位数字代码，如 `600519` (贵州茅台), `000001` (平安银行)  
+    - ​**A股**: 6位数字代码，如 `600519` (贵州茅台), `000001` (平安银行)
     - ​**港股**: 1-5位数字代码，如 `00700` (腾讯), `09988` (阿里巴巴)
     - ​**美股**: 字母代码，如 `AAPL` (苹果), `TSLA` (特斯拉)
-    """)
+    """
+
+def main():
+    _warm_popular_tickers()
+    st.title("📈 厉害了，股神")
+    st.markdown(_INTRO_MD)
 
-    # 输入区域
-    col1, col2 = st.columns([1, 2])
-    with col1:
-        st.markdown("​**股票代码**​")
-    with col2:
-        code = st.text_input("请输入股票代码：", "AAPL", label_visibility="collapsed")
+    # 输入区域：放进表单做防抖，输入过程不触发rerun，提交才开始分析
+    with st.form("query_form"):
+        col1, col2 = st.columns([1, 2])
+        with col1:
+            st.markdown("​**股票代码**​")
+        with col2:
+            code = st.text_input("请输入股票代码：", "AAPL", label_visibility="collapsed")
+        st.form_submit_button("🔍 开始分析", use_container_width=True)
 
     st.divider()
 
     if code:
-        with st.spinner("正在获取数据并分析..."):
-            df, display_code = get_stock_data(code)
-
-            if df is not None and not df.empty:
-                # 分析结果
-                mood, price_range, future_trend = analyze_stock(df)
-                
-                # 三列显示分析结果
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    st.markdown(f"​**当前行情情绪**​")
-                    st.info(mood)
-                
-                with col2:
-                    st.markdown(f"​**建议买入区间**​")
-                    st.success(price_range)
-                
-                with col3:
-                    st.markdown(f"​**未来趋势预测**​")
-                    st.warning(future_trend)
-
-                st.divider()
-
-                # 图表显示
-                plot_stock_charts(df, display_code)
-
-                # 最近数据表
-                st.subheader("📋 最近交易数据")
-                display_cols = ["date", "close", "MA5", "MA20", "MA50", "volume"]
-                available_cols = [col for col in display_cols if col in df.columns]
-                
-                if available_cols:
-                    recent_data = df.tail(10)[available_cols]
-                    # 格式化数字显示
-                    for col in recent_data.columns:
-                        if col != "date" and pd.api.types.is_numeric_dtype(recent_data[col]):
-                            recent_data[col] = recent_data[col].round(2)
-                    st.dataframe(recent_data, use_container_width=True)
-                
-                # 显示最新价格
-                latest_price = df.iloc[-1]["close"]
-                st.metric("最新收盘价", f"{latest_price:.2f}", 
-                         delta=f"{(latest_price - df.iloc[-2]['close']):.2f}" if len(df) > 1 else None)
-
-            else:
-                st.error("❌ 未能获取股票数据，请检查：")
-                st.error("1. 股票代码是否正确（A股: 600519, 港股: 00700, 美股: AAPL）")
-                st.error("2. 网络连接是否正常")
-                st.error("3. 该股票是否在交易时间")
+        render_analysis(code)
 
     st.divider()
+    with st.expander("🗂️ 缓存统计"):
+        disk_cache = get_disk_cache()
+        st.caption(f"磁盘缓存：命中 {disk_cache.hits} 次 / 未命中 {disk_cache.misses} 次")
     st.caption("💡 提示：本工具仅供参考，不构成投资建议")
     st.caption("🚀 支持市场：A股 • 港股 • 美股")
 
@@ -0,0 +1,116 @@
+# tools/cache.py
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+
+# 默认TTL：行情24小时，名称查询7天
+HIST_TTL = 24 * 3600
+NAME_TTL = 7 * 24 * 3600
+
+
+class FileCache:
+    """
+    跨会话的磁盘缓存，按 (market, code, start, end) 键存储pickle对象
+    数据文件: .cache/{market}/{code}_{start}_{end}.pkl
+    元数据:   同名 .meta.json，记录key/timestamp/ttl
+    """
+
+    def __init__(self, root=".cache"):
+        self.root = Path(root)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(market, code, start, end):
+        return hashlib.md5(f"{market}:{code}:{start}:{end}".encode()).hexdigest()
+
+    def _paths(self, market, code, start, end):
+        folder = self.root / str(market)
+        stem = f"{code}_{start}_{end}"
+        return folder / f"{stem}.pkl", folder / f"{stem}.meta.json"
+
+    def get(self, market, code, start, end):
+        """命中且未过期时返回缓存对象，否则返回None"""
+        data_path, meta_path = self._paths(market, code, start, end)
+        try:
+            meta = json.loads(meta_path.read_text())
+            if time.time() - meta["timestamp"] > meta["ttl"]:
+                self.misses += 1
+                return None
+            obj = pickle.loads(data_path.read_bytes())
+        except Exception:
+            # 缓存只是加速层：截断pickle抛EOFError等各种异常，一律当未命中
+            self.misses += 1
+            return None
+        self.hits += 1
+        return obj
+
+    def set(self, market, code, start, end, obj, ttl=HIST_TTL):
+        data_path, meta_path = self._paths(market, code, start, end)
+        data_path.parent.mkdir(parents=True, exist_ok=True)
+        payload = pickle.dumps(obj)
+        meta = {
+            "key": self.make_key(market, code, start, end),
+            "timestamp": time.time(),
+            "ttl": ttl,
+            "content_md5": hashlib.md5(payload).hexdigest(),
+        }
+        # 刷新时内容未变则只续期元数据，跳过重写数据文件
+        if data_path.exists():
+            try:
+                old = json.loads(meta_path.read_text())
+                if old.get("content_md5") == meta["content_md5"]:
+                    meta_path.write_text(json.dumps(meta))
+                    self._prune_superseded(code, keep=(data_path, meta_path))
+                    return
+            except (OSError, ValueError):
+                pass
+        # 先写临时文件再原子替换，进程中途被杀也不会留下半截数据文件
+        tmp_path = data_path.with_suffix(".pkl.tmp")
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, data_path)
+        meta_path.write_text(json.dumps(meta))
+        self._prune_superseded(code, keep=(data_path, meta_path))
+
+    def _prune_superseded(self, code, keep):
+        """
+        删除该股票被新窗口取代的旧缓存文件
+        键里带滚动日期窗口，不清理的话每只股票每天都会多出一对文件
+        """
+        for path in self.root.glob(f"*/{code}_*"):
+            if path in keep:
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def get_latest(self, market, code):
+        """
+        返回该股票最新一份缓存数据，忽略TTL
+        用作增量拉取的底仓：过期数据拼上新增交易日即可复用
+        """
+        folder = self.root / str(market)
+        if not folder.exists():
+            return None
+        candidates = sorted(folder.glob(f"{code}_*.pkl"),
+                            key=lambda p: p.stat().st_mtime)
+        for path in reversed(candidates):
+            try:
+                return pickle.loads(path.read_bytes())
+            except Exception:
+                continue
+        return None
+
+    def invalidate(self, code):
+        """删除某只股票的全部缓存文件（数据+元数据）"""
+        if not self.root.exists():
+            return
+        for path in self.root.glob(f"*/{code}_*"):
+            try:
+                path.unlink()
+            except OSError:
+                pass